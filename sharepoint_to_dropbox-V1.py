@@ -2,7 +2,6 @@ import os
 import sys
 from office365.runtime.auth.client_credential import ClientCredential
 from office365.sharepoint.client_context import ClientContext
-from office365.sharepoint.files.file import File
 import dropbox
 from dropbox import DropboxTeam
 from dropbox.files import FileMetadata, FolderMetadata
@@ -11,34 +10,8 @@ from dotenv import load_dotenv
 import logging
 from concurrent.futures import ThreadPoolExecutor
 import time
-import io
-import functools
-
-def rate_limited(max_per_second):
-    """
-    Decorador para limitar la cantidad de llamadas a la función.
-    
-    Args:
-        max_per_second (int): Número máximo de llamadas permitidas por segundo.
-    
-    Retorna:
-        función decorada que respeta el límite de llamadas.
-    """
-    min_interval = 1.0 / float(max_per_second)
-    
-    def decorator(func):
-        last_call = [0.0]  # Lista mutable para almacenar el último tiempo de llamada
-        @functools.wraps(func)
-        def wrapper(*args, **kwargs):
-            elapsed = time.perf_counter() - last_call[0]
-            sleep_time = min_interval - elapsed
-            if sleep_time > 0:
-                time.sleep(sleep_time)
-            result = func(*args, **kwargs)
-            last_call[0] = time.perf_counter()
-            return result
-        return wrapper
-    return decorator
+import tempfile
+import threading
 
 # Configuración de logging
 logging.basicConfig(
@@ -54,6 +27,13 @@ class SharePointToDropboxMigrator:
     """Clase para migrar archivos desde SharePoint a Dropbox de forma automatizada."""
     def __init__(self):
         load_dotenv()
+        # Límite de llamadas a upload_to_dropbox, propio de cada instancia
+        self._rate_interval = 0.5  # 2 llamadas por segundo (puedes ajustar este valor)
+        self._next_call = 0.0
+        self._rate_lock = threading.Lock()
+        # Un ClientContext por hilo de descarga: office365 guarda las consultas
+        # pendientes en el contexto, así que no puede compartirse entre hilos
+        self._local = threading.local()
         self.setup_sharepoint()
         self.setup_dropbox()
 
@@ -92,65 +72,91 @@ class SharePointToDropboxMigrator:
             self.dbx = dropbox.Dropbox(
                 app_key=app_key,
                 app_secret=app_secret,
-                oauth2_refresh_token=refresh_token
+                oauth2_refresh_token=refresh_token,
+                timeout=60,
+                max_retries_on_error=4,
+                max_retries_on_rate_limit=4,
+                user_agent='sp2dbx/1.0'
             )
 
-             # Verifica la conexión a la cuenta
-            self.dbx.users_get_current_account()
-            logging.info("Conexión a Dropbox establecida correctamente")
+            # Sin llamada de verificación: la primera operación real ya reporta errores de autenticación
+            logging.info("Cliente de Dropbox configurado")
          except Exception as dropbox_error:
              logging.error("Error al configurar Dropbox: %s", dropbox_error)
              raise
 
+    def _thread_ctx(self):
+        """Contexto de SharePoint del hilo actual; comparte la autenticación (y su token) con self.ctx."""
+        if not hasattr(self._local, "ctx"):
+            self._local.ctx = ClientContext(
+                self.ctx.authentication_context.url, auth_context=self.ctx.authentication_context
+            )
+        return self._local.ctx
+
     def download_from_sharepoint(self, file_url):
         """ 
-        Descarga un archivo desde SharePoint y retorna su contenido en bytes 
+        Descarga un archivo desde SharePoint en streaming a un archivo temporal
+        (en memoria hasta 256 MB, luego en disco) y lo retorna posicionado al inicio.
         """
+        spool = tempfile.SpooledTemporaryFile(max_size=256 * 1024 * 1024)
         try:
-            response = File.open_binary(self.ctx, file_url)
-            return response.content
+            ctx = self._thread_ctx()
+            ctx.web.get_file_by_server_relative_url(file_url).download_session(spool).execute_query()
+            spool.seek(0)
+            return spool
         except Exception as download_error:
+            spool.close()
             logging.error("Error al descargar %s: %s", file_url, str(download_error))
             return None
 
-    @rate_limited(2)  # Limita a 2 llamadas por segundo (puedes ajustar este valor)
-    def upload_to_dropbox(self, file_content, dropbox_path, chunk_size=4 * 1024 * 1024):
+    def upload_to_dropbox(self, file_obj, dropbox_path, chunk_size=4 * 1024 * 1024):
         """
         Sube un archivo a Dropbox.
         Si el archivo es mayor a 150 MB, utiliza carga en sesiones (chunked upload).
         
         Args:
-            file_content (bytes): Contenido del archivo.
+            file_obj: Archivo binario abierto y posicionado al inicio.
             dropbox_path (str): Ruta de destino en Dropbox.
             chunk_size (int, opcional): Tamaño de cada chunk en bytes. Por defecto, 4 MB.
         
         Returns:
             bool: True si la subida fue exitosa, False en caso contrario.
         """
+        # Reserva el siguiente turno bajo el lock y espera fuera de él
+        with self._rate_lock:
+            now = time.monotonic()
+            delay = self._next_call - now
+            self._next_call = max(now, self._next_call) + self._rate_interval
+        if delay > 0:
+            time.sleep(delay)
+
         try:
-            file_size = len(file_content)
+            file_obj.seek(0, os.SEEK_END)
+            file_size = file_obj.tell()
+            file_obj.seek(0)
             threshold = 150 * 1024 * 1024  # 150 MB de umbral
             
             if file_size <= threshold:
-                self.dbx.files_upload(file_content, dropbox_path)
+                self.dbx.files_upload(file_obj.read(), dropbox_path)
                 logging.info("Archivo subido exitosamente (carga directa): %s", dropbox_path)
             else:
-                stream = io.BytesIO(file_content)
-                # Inicia la sesión de carga leyendo el primer chunk
-                session_start_result = self.dbx.files_upload_session_start(stream.read(chunk_size))
+                # Solo un chunk en memoria a la vez; el resto queda en el archivo temporal
+                chunk = file_obj.read(chunk_size)
+                session_start_result = self.dbx.files_upload_session_start(chunk)
                 cursor = dropbox.files.UploadSessionCursor(
                     session_id=session_start_result.session_id,
-                    offset=stream.tell()
+                    offset=len(chunk)
                 )
                 commit = dropbox.files.CommitInfo(path=dropbox_path)
-                
+
                 # Envía el archivo en chunks
-                while stream.tell() < file_size:
-                    if (file_size - stream.tell()) <= chunk_size:
-                        self.dbx.files_upload_session_finish(stream.read(chunk_size), cursor, commit)
-                    else:
-                        self.dbx.files_upload_session_append_v2(stream.read(chunk_size), cursor)
-                        cursor.offset = stream.tell()
+                while cursor.offset < file_size:
+                    chunk = file_obj.read(chunk_size)
+                    if cursor.offset + len(chunk) >= file_size:
+                        self.dbx.files_upload_session_finish(chunk, cursor, commit)
+                        break
+                    self.dbx.files_upload_session_append_v2(chunk, cursor)
+                    cursor.offset += len(chunk)
                 logging.info("Archivo subido exitosamente (carga en sesiones): %s", dropbox_path)
             return True
         except (dropbox.exceptions.ApiError, IOError) as upload_error:
@@ -160,9 +166,10 @@ class SharePointToDropboxMigrator:
     def migrate_file(self, sharepoint_path, dropbox_path):
         """Migra un archivo individual"""
         try:
-            file_content = self.download_from_sharepoint(sharepoint_path)
-            if file_content:
-                success = self.upload_to_dropbox(file_content, dropbox_path)
+            file_obj = self.download_from_sharepoint(sharepoint_path)
+            if file_obj is not None:
+                with file_obj:
+                    success = self.upload_to_dropbox(file_obj, dropbox_path)
                 if success:
                     logging.info("Archivo migrado exitosamente: %s -> %s", sharepoint_path, dropbox_path)
                     return True
@@ -1,54 +1,162 @@
 import os
 import sys
-import io
+import json
+import hashlib
+import argparse
 import time
+import random
 import functools
+import queue
+import threading
+import atexit
 import logging
-from concurrent.futures import ThreadPoolExecutor
+import tempfile
+from logging.handlers import QueueHandler, QueueListener
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from urllib.parse import quote, unquote
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from dotenv import load_dotenv
 from tqdm import tqdm
 
 from office365.runtime.auth.client_credential import ClientCredential
+from office365.runtime.http.request_options import RequestOptions
 from office365.sharepoint.client_context import ClientContext
-from office365.sharepoint.files.file import File
 
-from dropbox import DropboxTeam
-from dropbox.files import WriteMode, UploadSessionCursor, CommitInfo, FileMetadata, FolderMetadata
+from dropbox import DropboxTeam, create_session
+from dropbox.content_hash import DropboxContentHasher
+from dropbox.exceptions import ApiError, AuthError, RateLimitError
+from dropbox.team import UserSelectorArg
+from dropbox.files import (
+    WriteMode, UploadSessionCursor, UploadSessionType, CommitInfo, UploadSessionFinishArg,
+    FileMetadata, FolderMetadata,
+)
+
+# Archivos hasta este tamaño se suben sin sesión por chunks (recomendación de Dropbox)
+UPLOAD_THRESHOLD = 150 * 1024 * 1024
+# Hilos que descargan/suben archivos en paralelo (sobrescribible con MAX_WORKERS en el .env)
+MAX_WORKERS = 5
+# Chunks de un mismo archivo grande subidos en paralelo (sesión concurrente)
+CHUNK_WORKERS = 8
+# Segundos máximos que un worker espera una respuesta de Dropbox
+DROPBOX_TIMEOUT = 60
+USER_AGENT = 'sp2dbx/1.0'
+# Ritmo global de llamadas a la API de Dropbox, compartido por todos los hilos
+# (los appends de chunks de sesiones no cuentan: los limita CHUNK_WORKERS)
+MAX_CALLS_PER_SECOND = 5
+# Reintentos ante RateLimitError (429) antes de dar por fallida la llamada
+RATE_LIMIT_RETRIES = 4
+# Archivos listados en espera de ser migrados (backpressure del listado)
+LISTING_QUEUE_SIZE = 1000
+# Máximo de archivos por llamada a files_upload_session_finish_batch_v2
+BATCH_MAX_ENTRIES = 1000
+# Únicas propiedades de archivo que usa la migración (reduce el JSON de cada listado)
+FILE_FIELDS = ["Name", "ServerRelativeUrl", "Length"]
+# Máximo de rutas por llamada a files_create_folder_batch
+FOLDER_BATCH_MAX = 10000
+# Archivos hasta este tamaño pasan de los hilos de descarga a los de subida por una cola
+QUEUED_FILE_MAX = 4 * 1024 * 1024
+# Archivos descargados en espera de subida (acota la memoria a ~QUEUED_FILE_MAX * este valor)
+UPLOAD_QUEUE_SIZE = 64
+# Hilos que consumen la cola de subida
+UPLOAD_WORKERS = 2
+# Caché local del access token y de los team_member_id de Dropbox (evita repetir esas llamadas en cada ejecución)
+DROPBOX_CACHE_PATH = os.path.expanduser('~/.cache/sp2dbx/token.json')
+# Margen mínimo de vigencia para reutilizar un token en caché
+TOKEN_MIN_TTL = timedelta(seconds=300)
+
+
+# Errores de red transitorios que justifican reintentar una llamada
+TRANSIENT_ERRORS = (requests.exceptions.ConnectionError, requests.exceptions.Timeout)
 
 
-def rate_limited(max_per_second):
-    """Decorador para limitar la cantidad de llamadas a la función."""
-    min_interval = 1.0 / float(max_per_second)
+def retry(max_attempts=4, backoff_base=1.0, backoff_cap=30.0, retry_on=TRANSIENT_ERRORS):
+    """Decorador que reintenta la función ante errores transitorios con backoff exponencial y jitter."""
     def decorator(func):
-        last_call = [0.0]
         @functools.wraps(func)
         def wrapper(*args, **kwargs):
-            elapsed = time.perf_counter() - last_call[0]
-            sleep_time = min_interval - elapsed
-            if sleep_time > 0:
-                time.sleep(sleep_time)
-            result = func(*args, **kwargs)
-            last_call[0] = time.perf_counter()
-            return result
+            for attempt in range(max_attempts):
+                try:
+                    return func(*args, **kwargs)
+                except retry_on as e:
+                    if attempt == max_attempts - 1:
+                        raise
+                    delay = min(backoff_cap, backoff_base * 2 ** attempt) + random.uniform(0, 1)
+                    logging.warning("%s falló (%s); reintento %d/%d en %.1fs",
+                                    func.__name__, e, attempt + 1, max_attempts - 1, delay)
+                    time.sleep(delay)
         return wrapper
     return decorator
 
-# Configuración de logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('migration.log'),
-        logging.StreamHandler(sys.stdout)
-    ]
-)
+def read_chunk(stream, size):
+    """Lee exactamente `size` bytes del stream (menos solo al llegar al final)."""
+    data = stream.read(size)
+    if len(data) == size or not data:
+        return data
+    parts = [data]
+    remaining = size - len(data)
+    while remaining:
+        part = stream.read(remaining)
+        if not part:
+            break
+        parts.append(part)
+        remaining -= len(part)
+    return b"".join(parts)
+
+def load_dropbox_cache():
+    """Lee la caché local de Dropbox; retorna un dict vacío si no existe o está corrupta."""
+    try:
+        with open(DROPBOX_CACHE_PATH, encoding='utf-8') as fh:
+            return json.load(fh)
+    except (OSError, ValueError):
+        return {}
+
+def save_dropbox_cache(cache):
+    """Escribe la caché de forma atómica y con permisos 0600 (contiene tokens)."""
+    os.makedirs(os.path.dirname(DROPBOX_CACHE_PATH), exist_ok=True)
+    tmp_path = f"{DROPBOX_CACHE_PATH}.{os.getpid()}.{threading.get_ident()}.tmp"
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w', encoding='utf-8') as fh:
+        json.dump(cache, fh)
+    os.replace(tmp_path, DROPBOX_CACHE_PATH)
+
+# Configuración de logging: los hilos solo encolan registros y un listener
+# en segundo plano los escribe, así la E/S del log no bloquea a los workers
+_log_formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+_log_handlers = [logging.FileHandler('migration.log'), logging.StreamHandler(sys.stdout)]
+for _handler in _log_handlers:
+    _handler.setFormatter(_log_formatter)
+_log_queue = queue.Queue(-1)
+_queue_handler = QueueHandler(_log_queue)
+_queue_handler.setFormatter(logging.Formatter('%(message)s'))
+logging.basicConfig(level=logging.INFO, handlers=[_queue_handler])
+_log_listener = QueueListener(_log_queue, *_log_handlers)
+_log_listener.start()
+atexit.register(_log_listener.stop)
 
 class SharePointToDropboxMigrator:
     """Clase para migrar archivos desde SharePoint a Dropbox Business (Team) por usuario."""
     def __init__(self):
         load_dotenv()
+        self._rate_lock = threading.Lock()
+        self._min_interval = 1.0 / MAX_CALLS_PER_SECOND
+        self._next_allowed = 0.0
+        # Pausa global tras un 429; también la respetan las llamadas no pautadas
+        self._paused_until = 0.0
+        self.max_workers = int(os.getenv('MAX_WORKERS', MAX_WORKERS))
+        self._batch = []
+        self._batch_lock = threading.Lock()
+        # Serializa la lectura/escritura de la caché de Dropbox entre hilos
+        self._cache_lock = threading.Lock()
         self.setup_sharepoint()
         self.setup_dropbox()
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='migrate')
+
+    def close(self):
+        """Espera a que terminen las transferencias en curso y libera el pool de workers"""
+        self._executor.shutdown(wait=True)
 
     def setup_sharepoint(self):
         """Configura la conexión con SharePoint"""
@@ -59,6 +167,15 @@ class SharePointToDropboxMigrator:
             raise ValueError("Faltan credenciales de SharePoint en el archivo .env")
         credentials = ClientCredential(client_id, client_secret)
         self.ctx = ClientContext(site_url).with_credentials(credentials)
+        # Sesión HTTP compartida para las descargas: reutiliza conexiones TLS entre archivos.
+        # Es la única capa de reintentos de las descargas (respeta Retry-After)
+        self.http = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=10,
+            pool_maxsize=max(20, self.max_workers),
+            max_retries=Retry(total=5, backoff_factor=0.5, status_forcelist=[429, 502, 503, 504]),
+        )
+        self.http.mount("https://", adapter)
         web = self.ctx.web
         self.ctx.load(web)
         self.ctx.execute_query()
@@ -74,113 +191,678 @@ class SharePointToDropboxMigrator:
         if not all([app_key, app_secret, refresh_token, member_email]):
             raise ValueError("Faltan variables de Dropbox en .env: DROPBOX_APP_KEY, DROPBOX_APP_SECRET, DROPBOX_REFRESH_TOKEN, DROPBOX_MEMBER_EMAIL")
 
+        # Reutiliza el access token en caché si aún le queda vigencia suficiente.
+        # La entrada se identifica por app y refresh token: otro refresh token de
+        # la misma app (p.ej. de otro equipo) no reutiliza tokens ajenos
+        cache = load_dropbox_cache()
+        cache.pop(app_key, None)  # formato anterior, solo por app_key
+        cache_key = f"{app_key}:{hashlib.sha256(refresh_token.encode('utf-8')).hexdigest()[:16]}"
+        cached = cache.get(cache_key, {})
+        access_token, expiration = None, None
+        if cached.get('access_token') and cached.get('expires_at'):
+            expires_at = datetime.fromisoformat(cached['expires_at'])
+            if expires_at.tzinfo is None:
+                # Cachés antiguas guardaban la hora UTC sin zona
+                expires_at = expires_at.replace(tzinfo=timezone.utc)
+            if expires_at - datetime.now(timezone.utc) > TOKEN_MIN_TTL:
+                access_token = cached['access_token']
+                # El SDK compara la expiración con la hora UTC sin zona
+                expiration = expires_at.astimezone(timezone.utc).replace(tzinfo=None)
+
         # Conecta al equipo
         team_client = DropboxTeam(
+            oauth2_access_token=access_token,
+            oauth2_access_token_expiration=expiration,
             app_key=app_key,
             app_secret=app_secret,
-            oauth2_refresh_token=refresh_token
+            oauth2_refresh_token=refresh_token,
+            session=create_session(max_connections=self.max_workers + CHUNK_WORKERS),
+            timeout=DROPBOX_TIMEOUT,
+            max_retries_on_error=4,
+            max_retries_on_rate_limit=4,
+            user_agent=USER_AGENT
         )
+        if not access_token:
+            self._refresh_dropbox_token(team_client, cache, cache_key)
 
-        # Busca el team_member_id por email
-        logging.info(f"Buscando miembro en el team: %s", member_email)
-        result = team_client.team_members_list()
-        team_member_id = None
-        for m in result.members:
-            if m.profile.email.lower() == member_email.lower():
-                team_member_id = m.profile.team_member_id
-                break
+        # Busca el team_member_id por email (o lo toma de la caché local). Con
+        # caché también se hace una llamada de equipo, para que un token revocado
+        # o un miembro que ya no existe se detecten aquí y no al subir cada archivo
+        members = cache.setdefault(cache_key, {}).setdefault('members', {})
+        email_key = member_email.casefold()
+        cached_member_id = members.get(email_key)
+        try:
+            team_member_id = self._resolve_member(team_client, member_email, cached_member_id)
+        except AuthError:
+            if not access_token:
+                raise
+            logging.warning("Token de Dropbox en caché rechazado, renovando con refresh token")
+            self._refresh_dropbox_token(team_client, cache, cache_key)
+            team_member_id = self._resolve_member(team_client, member_email, cached_member_id)
+        if team_member_id != cached_member_id:
+            if team_member_id:
+                members[email_key] = team_member_id
+            else:
+                members.pop(email_key, None)
+            self._save_cache(cache)
         if not team_member_id:
             raise ValueError(f"No encontré a {member_email} en el equipo de Dropbox")
 
         # Impersona al usuario
+        self._member_cache_key = (cache_key, email_key)
         self.dbx = team_client.as_user(team_member_id)
         logging.info("Impersonación OK para %s -> %s", member_email, team_member_id)
 
+    def _resolve_member(self, team_client, member_email, cached_member_id):
+        """
+        Comprueba el team_member_id de la caché con una consulta por id; si ya no
+        corresponde a un miembro activo con ese email, lo busca de nuevo por email.
+        """
+        if cached_member_id:
+            info = team_client.team_members_get_info_v2([UserSelectorArg.team_member_id(cached_member_id)])
+            item = info.members_info[0]
+            if item.is_member_info():
+                profile = item.get_member_info().profile
+                if profile.status.is_active() and profile.email.casefold() == member_email.casefold():
+                    logging.info("team_member_id de %s tomado de la caché", member_email)
+                    return cached_member_id
+            logging.warning("team_member_id en caché de %s ya no es válido, se busca de nuevo", member_email)
+        logging.info("Buscando miembro en el team: %s", member_email)
+        return self._find_team_member_id(team_client, member_email)
+
+    def _find_team_member_id(self, team_client, member_email):
+        """
+        Resuelve el team_member_id con una consulta directa por email; si no
+        aparece, recorre el listado completo del equipo paginando.
+        """
+        info = team_client.team_members_get_info_v2([UserSelectorArg.email(member_email)])
+        item = info.members_info[0]
+        if item.is_member_info():
+            return item.get_member_info().profile.team_member_id
+        target = member_email.casefold()
+        result = team_client.team_members_list_v2()
+        while True:
+            for m in result.members:
+                if m.profile.email.casefold() == target:
+                    return m.profile.team_member_id
+            if not result.has_more:
+                return None
+            result = team_client.team_members_list_continue_v2(result.cursor)
+
+    def _refresh_dropbox_token(self, team_client, cache, cache_key):
+        """Obtiene un access token nuevo con el refresh token y lo guarda en la caché local."""
+        team_client.refresh_access_token()
+        # El SDK no expone el token renovado: si cambian sus atributos internos,
+        # simplemente no se cachea y la próxima ejecución renueva de nuevo
+        access_token = getattr(team_client, '_oauth2_access_token', None)
+        expiration = getattr(team_client, '_oauth2_access_token_expiration', None)
+        if not isinstance(access_token, str) or not isinstance(expiration, datetime):
+            logging.warning("No se pudo leer el access token renovado; no se guarda en caché")
+            return
+        if expiration.tzinfo is None:
+            expiration = expiration.replace(tzinfo=timezone.utc)
+        cache.setdefault(cache_key, {}).update({
+            'access_token': access_token,
+            'expires_at': expiration.isoformat(),
+        })
+        self._save_cache(cache)
+
+    def _forget_cached_member(self):
+        """Quita de la caché el team_member_id del miembro actual."""
+        cache_key, email_key = self._member_cache_key
+        with self._cache_lock:
+            cache = load_dropbox_cache()
+            if cache.get(cache_key, {}).get('members', {}).pop(email_key, None) is not None:
+                logging.warning("team_member_id de %s rechazado por Dropbox, eliminado de la caché", email_key)
+                self._save_cache(cache)
+
+    def _save_cache(self, cache):
+        """Guarda la caché de Dropbox; un fallo de escritura no detiene la migración."""
+        try:
+            save_dropbox_cache(cache)
+        except OSError as e:
+            logging.warning("No se pudo guardar la caché de Dropbox: %s", e)
+
+    def _acquire_slot(self):
+        """Reserva un turno en el ritmo global de llamadas a Dropbox y espera si hace falta."""
+        with self._rate_lock:
+            now = time.monotonic()
+            wait = max(0.0, self._next_allowed - now)
+            self._next_allowed = max(now, self._next_allowed) + self._min_interval
+        if wait:
+            time.sleep(wait)
+
+    def _wait_pause(self):
+        """Espera a que termine la pausa global por rate limit, sin consumir turno."""
+        wait = self._paused_until - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+
+    @retry()
+    def _dropbox_call(self, method, *args, paced=True, **kwargs):
+        """
+        Ejecuta una llamada a la API de Dropbox respetando el ritmo global.
+        Ante un RateLimitError pausa a todos los hilos el tiempo indicado por
+        Dropbox (o con backoff exponencial) y reintenta; los errores de red
+        transitorios se reintentan con @retry.
+        Con paced=False (subida de chunks) no consume turno del ritmo global,
+        pero sí respeta la pausa por rate limit.
+        """
+        for attempt in range(RATE_LIMIT_RETRIES + 1):
+            if paced:
+                self._acquire_slot()
+            else:
+                self._wait_pause()
+            try:
+                return method(*args, **kwargs)
+            except AuthError as e:
+                # El miembro impersonado dejó de ser válido: se olvida su id en caché
+                # para que la próxima ejecución lo busque de nuevo por email
+                if e.error.is_invalid_select_user():
+                    self._forget_cached_member()
+                raise
+            except RateLimitError as e:
+                if attempt == RATE_LIMIT_RETRIES:
+                    raise
+                delay = e.backoff or min(60, 2 ** attempt)
+                logging.warning("Rate limit de Dropbox, reintentando en %ss", delay)
+                with self._rate_lock:
+                    until = time.monotonic() + delay
+                    self._next_allowed = max(self._next_allowed, until)
+                    self._paused_until = max(self._paused_until, until)
+
+    def _open_download(self, file_url):
+        """
+        Abre la descarga en streaming del archivo; lanza excepción si falla.
+        Los reintentos los hace el adaptador de self.http (conexión, 429 y 5xx).
+        """
+        decoded_url = unquote(file_url).replace("'", "''")
+        url = quote(
+            f"{self.ctx.service_root_url()}/web/getFileByServerRelativePath(DecodedUrl='{decoded_url}')/$value",
+            safe=":/",
+        )
+        request = RequestOptions(url)
+        self.ctx.authentication_context.authenticate_request(request)
+        response = self.http.get(request.url, headers=request.headers, auth=request.auth, stream=True)
+        try:
+            response.raise_for_status()
+        except requests.HTTPError:
+            # Con stream=True la conexión no vuelve al pool hasta cerrar la respuesta
+            response.close()
+            raise
+        response.raw.decode_content = True
+        return response
+
     def download_from_sharepoint(self, file_url):
-        """Descarga un archivo desde SharePoint y retorna su contenido en bytes"""
+        """
+        Abre una descarga en streaming desde SharePoint.
+        Retorna la respuesta HTTP (sin leer el cuerpo) o None si falla.
+        """
         try:
-            response = File.open_binary(self.ctx, file_url)
-            return response.content
+            return self._open_download(file_url)
         except Exception as e:
             logging.error("Error al descargar %s: %s", file_url, e)
             return None
 
-    @rate_limited(2)
-    def upload_to_dropbox(self, file_content, dropbox_path, chunk_size=4*1024*1024):
+    def upload_to_dropbox(self, source_stream, size, dropbox_path, chunk_size=4*1024*1024):
         """
-        Sube un archivo a Dropbox Business impersonado
-        Si el archivo es mayor a 150 MB, utiliza carga en sesiones (chunked upload).
-        
+        Sube un archivo a Dropbox Business impersonado leyendo desde un stream.
+        Si el archivo es mayor a 150 MB (o su tamaño es desconocido), utiliza una
+        sesión concurrente: los chunks se leen en orden y se suben en paralelo
+        (hasta CHUNK_WORKERS en vuelo), sin cargar el archivo completo en memoria.
+
         Args:
-            file_content (bytes): Contenido del archivo.
+            source_stream: Objeto con método read(n), p.ej. el cuerpo de la respuesta de SharePoint.
+            size (int): Tamaño del archivo en bytes (None si es desconocido).
             dropbox_path (str): Ruta de destino en Dropbox.
-            chunk_size (int, opcional): Tamaño de cada chunk en bytes. Por defecto, 4 MB.
-        
+            chunk_size (int, opcional): Tamaño de cada chunk en bytes; debe ser múltiplo de 4 MB. Por defecto, 4 MB.
+
         Returns:
             bool: True si la subida fue exitosa, False en caso contrario.
         """
         try:
-            size = len(file_content)
-            threshold = 150 * 1024 * 1024
-            if size <= threshold:
-                self.dbx.files_upload(file_content, dropbox_path, mode=WriteMode.overwrite)
+            if size is not None and size <= UPLOAD_THRESHOLD:
+                self._dropbox_call(self.dbx.files_upload, source_stream.read(), dropbox_path, mode=WriteMode.overwrite)
                 logging.info("Upload directo: %s", dropbox_path)
             else:
-                stream = io.BytesIO(file_content)
-                session = self.dbx.files_upload_session_start(stream.read(chunk_size))
-                cursor = UploadSessionCursor(session.session_id, offset=stream.tell())
+                session = self._dropbox_call(
+                    self.dbx.files_upload_session_start, b'', session_type=UploadSessionType.concurrent
+                )
+                in_flight = threading.BoundedSemaphore(CHUNK_WORKERS)
+                offset = 0
+                with ThreadPoolExecutor(max_workers=CHUNK_WORKERS) as pool:
+                    pending = set()
+                    while True:
+                        chunk = read_chunk(source_stream, chunk_size)
+                        if len(chunk) < chunk_size:
+                            break
+                        in_flight.acquire()
+                        # Si un chunk ya falló se aborta sin seguir leyendo el origen
+                        for fut in [f for f in pending if f.done()]:
+                            pending.discard(fut)
+                            fut.result()
+                        cursor = UploadSessionCursor(session.session_id, offset=offset)
+                        pending.add(pool.submit(self._append_chunk, chunk, cursor, in_flight))
+                        offset += len(chunk)
+                    for fut in pending:
+                        fut.result()
+                # El append que cierra la sesión va solo cuando todos los anteriores
+                # llegaron: una sesión cerrada rechaza appends posteriores
+                cursor = UploadSessionCursor(session.session_id, offset=offset)
+                self._dropbox_call(self.dbx.files_upload_session_append_v2, chunk, cursor, close=True, paced=False)
+                offset += len(chunk)
+                cursor = UploadSessionCursor(session.session_id, offset=offset)
                 commit = CommitInfo(path=dropbox_path, mode=WriteMode.overwrite)
-                while stream.tell() < size:
-                    if (size - stream.tell()) <= chunk_size:
-                        self.dbx.files_upload_session_finish(stream.read(chunk_size), cursor, commit)
-                    else:
-                        self.dbx.files_upload_session_append_v2(stream.read(chunk_size), cursor)
-                        cursor.offset = stream.tell()
+                self._dropbox_call(self.dbx.files_upload_session_finish, b'', cursor, commit)
                 logging.info("Upload sesional: %s", dropbox_path)
             return True
         except Exception as e:
             logging.error("Error uploading %s: %s", dropbox_path, e)
             return False
 
-    def migrate_file(self, sp_path, dbx_path):
-        content = self.download_from_sharepoint(sp_path)
-        if content:
-            if self.upload_to_dropbox(content, dbx_path):
+    def _append_chunk(self, chunk, cursor, in_flight):
+        """Sube un chunk a una sesión concurrente y libera su lugar en `in_flight`."""
+        try:
+            self._dropbox_call(self.dbx.files_upload_session_append_v2, chunk, cursor, paced=False)
+        finally:
+            in_flight.release()
+
+    def list_dropbox_files(self, dropbox_folder):
+        """Retorna {nombre en minúsculas: FileMetadata} de los archivos ya presentes en la carpeta de Dropbox"""
+        try:
+            res = self._dropbox_call(self.dbx.files_list_folder, dropbox_folder)
+        except ApiError as e:
+            if e.error.is_path() and e.error.get_path().is_not_found():
+                return {}
+            raise
+        existing = {}
+        while True:
+            for entry in res.entries:
+                if isinstance(entry, FileMetadata):
+                    existing[entry.name.lower()] = entry
+            if not res.has_more:
+                return existing
+            res = self._dropbox_call(self.dbx.files_list_folder_continue, res.cursor)
+
+    def spool_if_changed(self, stream, remote, chunk_size=4*1024*1024):
+        """
+        Copia el stream a un archivo temporal (en memoria hasta QUEUED_FILE_MAX)
+        calculando el content_hash de Dropbox (SHA256 por bloques de 4 MB) y lo
+        compara con el del archivo remoto. Así la misma descarga sirve para
+        comparar y, si cambió, para subir.
+
+        Returns:
+            SpooledTemporaryFile | None: Copia rebobinada si el contenido difiere;
+            None si es idéntico al remoto.
+        """
+        spool = tempfile.SpooledTemporaryFile(max_size=QUEUED_FILE_MAX)
+        try:
+            hasher = DropboxContentHasher()
+            while True:
+                chunk = read_chunk(stream, chunk_size)
+                hasher.update(chunk)
+                spool.write(chunk)
+                if len(chunk) < chunk_size:
+                    break
+        except Exception:
+            spool.close()
+            raise
+        if hasher.hexdigest() == remote.content_hash:
+            spool.close()
+            return None
+        spool.seek(0)
+        return spool
+
+    def download_small_file(self, sp_path, dbx_path, uploads, remote=None):
+        """
+        Descarga un archivo de hasta 150 MB y lo deja en el commit por lotes. Los de
+        hasta QUEUED_FILE_MAX se encolan en `uploads` para los hilos de subida; los
+        mayores se suben por chunks desde este hilo, sin tenerlos completos en memoria.
+        Si se indica `remote` y su content_hash coincide, no sube nada.
+
+        Returns:
+            Future | bool: Future que se resuelve a True/False cuando Dropbox confirma
+            el lote; o directamente True (omitido) / False (fallo antes de subir).
+        """
+        response = self.download_from_sharepoint(sp_path)
+        if response is None:
+            return False
+        outcome = Future()
+        spool = None
+        try:
+            with response:
+                source = response.raw
+                if remote is not None:
+                    spool = self.spool_if_changed(source, remote)
+                    if spool is None:
+                        logging.info("Sin cambios, omitido: %s", dbx_path)
+                        return True
+                    source = spool
+                head = read_chunk(source, QUEUED_FILE_MAX + 1)
+                if len(head) > QUEUED_FILE_MAX:
+                    self.stage_streamed_file(head, source, dbx_path, outcome)
+                    return outcome
+        except Exception as e:
+            logging.error("Error al descargar %s: %s", sp_path, e)
+            return False
+        finally:
+            if spool is not None:
+                spool.close()
+        if uploads.full():
+            logging.info("Cola de subida llena (%d archivos): las descargas esperan a Dropbox", uploads.maxsize)
+        uploads.put((head, dbx_path, outcome))
+        return outcome
+
+    def stage_small_file(self, data, dbx_path, outcome):
+        """
+        Sube el contenido a una sesión de carga ya cerrada y la agrega al lote
+        pendiente de commit. `outcome` se resuelve con el resultado final.
+        """
+        try:
+            session = self._dropbox_call(self.dbx.files_upload_session_start, data, close=True)
+        except Exception as e:
+            logging.error("Error uploading %s: %s", dbx_path, e)
+            outcome.set_result(False)
+            return
+        self._add_to_batch(session.session_id, len(data), dbx_path, outcome)
+
+    def stage_streamed_file(self, head, stream, dbx_path, outcome, chunk_size=4*1024*1024):
+        """
+        Como stage_small_file, pero leyendo el resto del stream por chunks: en
+        memoria solo están `head` y el chunk en curso.
+        """
+        try:
+            session = self._dropbox_call(self.dbx.files_upload_session_start, head)
+            offset = len(head)
+            while True:
+                chunk = read_chunk(stream, chunk_size)
+                last = len(chunk) < chunk_size
+                cursor = UploadSessionCursor(session.session_id, offset=offset)
+                self._dropbox_call(self.dbx.files_upload_session_append_v2, chunk, cursor, close=last, paced=False)
+                offset += len(chunk)
+                if last:
+                    break
+        except Exception as e:
+            logging.error("Error uploading %s: %s", dbx_path, e)
+            outcome.set_result(False)
+            return
+        self._add_to_batch(session.session_id, offset, dbx_path, outcome)
+
+    def _add_to_batch(self, session_id, size, dbx_path, outcome):
+        """Agrega una sesión cerrada al lote; al llegar a BATCH_MAX_ENTRIES hace el commit."""
+        cursor = UploadSessionCursor(session_id, offset=size)
+        commit = CommitInfo(path=dbx_path, mode=WriteMode.overwrite)
+        with self._batch_lock:
+            self._batch.append((UploadSessionFinishArg(cursor, commit), outcome))
+            if len(self._batch) < BATCH_MAX_ENTRIES:
+                return
+            batch, self._batch = self._batch, []
+        self.commit_upload_batch(batch)
+
+    def upload_worker(self, uploads):
+        """Consumidor de la cola de subida; termina al recibir None."""
+        while True:
+            item = uploads.get()
+            if item is None:
+                return
+            data, dbx_path, outcome = item
+            try:
+                self.stage_small_file(data, dbx_path, outcome)
+            except Exception as e:
+                # Un error inesperado no debe matar al hilo: la cola quedaría sin consumidor
+                logging.error("Error inesperado subiendo %s: %s", dbx_path, e)
+                if not outcome.done():
+                    outcome.set_result(False)
+
+    def flush_upload_batch(self):
+        """Hace commit de las sesiones que quedaron en el lote pendiente."""
+        with self._batch_lock:
+            batch, self._batch = self._batch, []
+        if batch:
+            self.commit_upload_batch(batch)
+
+    def commit_upload_batch(self, batch):
+        """
+        Hace commit de hasta BATCH_MAX_ENTRIES sesiones cerradas en una sola llamada
+        y resuelve el Future de cada archivo con su resultado.
+
+        Args:
+            batch (list): Pares (UploadSessionFinishArg, Future).
+
+        Returns:
+            int: Cantidad de archivos confirmados correctamente.
+        """
+        try:
+            result = self._dropbox_call(self.dbx.files_upload_session_finish_batch_v2, [arg for arg, _ in batch])
+        except Exception as e:
+            logging.error("Error en commit por lotes (%d archivos): %s", len(batch), e)
+            for _, outcome in batch:
+                outcome.set_result(False)
+            return 0
+        committed = 0
+        for (entry, outcome), status in zip(batch, result.entries):
+            if status.is_success():
+                committed += 1
+                logging.info("Upload por lotes: %s", entry.commit.path)
+            else:
+                logging.error("Error uploading %s: %s", entry.commit.path, status.get_failure())
+            outcome.set_result(status.is_success())
+        # Sin estado en la respuesta: no se puede dar por subido
+        for _, outcome in batch[len(result.entries):]:
+            outcome.set_result(False)
+        return committed
+
+    def migrate_file(self, sp_path, dbx_path, remote=None):
+        response = self.download_from_sharepoint(sp_path)
+        if response is None:
+            return False
+        with response:
+            length = response.headers.get('Content-Length')
+            size = int(length) if length is not None else None
+            if remote is None:
+                uploaded = self.upload_to_dropbox(response.raw, size, dbx_path)
+            else:
+                try:
+                    spool = self.spool_if_changed(response.raw, remote)
+                except Exception as e:
+                    logging.error("Error al descargar %s: %s", sp_path, e)
+                    return False
+                if spool is None:
+                    logging.info("Sin cambios, omitido: %s", dbx_path)
+                    return True
+                with spool:
+                    uploaded = self.upload_to_dropbox(spool, remote.size, dbx_path)
+            if uploaded:
                 logging.info("Migrado: %s -> %s", sp_path, dbx_path)
                 return True
         return False
 
-    def start_migration(self, source_folder, target_folder):
-        folder = self.ctx.web.get_folder_by_server_relative_url(source_folder).expand(["Files", "Folders"])
-        self.ctx.load(folder)
-        self.ctx.execute_query()
-        files = folder.files
-        subs  = folder.folders
+    def list_folder(self, server_relative_url, page_size=2000):
+        """
+        Genera los archivos de una carpeta de SharePoint pidiéndolos por páginas,
+        para no truncar carpetas que superan el umbral de vista de lista (5000).
+        """
+        files = self.ctx.web.get_folder_by_server_relative_url(server_relative_url).files
+        files.select(FILE_FIELDS).paged(page_size).get().execute_query()
+        if len(files) >= page_size and not files.has_next:
+            # Página llena sin enlace a la siguiente: no hay paginación en el
+            # servidor, así que se pide la colección completa para no truncarla
+            files = self.ctx.web.get_folder_by_server_relative_url(server_relative_url).files
+            files.select(FILE_FIELDS).get().execute_query()
+        yield from files
+
+    def create_dropbox_folders(self, paths):
+        """
+        Crea en Dropbox todas las carpetas de `paths` con files_create_folder_batch,
+        esperando a que termine el job asíncrono. Las que ya existen se ignoran.
+        """
+        for i in range(0, len(paths), FOLDER_BATCH_MAX):
+            chunk = paths[i:i + FOLDER_BATCH_MAX]
+            try:
+                launch = self._dropbox_call(self.dbx.files_create_folder_batch, chunk, force_async=True)
+                if launch.is_complete():
+                    result = launch.get_complete()
+                else:
+                    job_id = launch.get_async_job_id()
+                    while True:
+                        status = self._dropbox_call(self.dbx.files_create_folder_batch_check, job_id)
+                        if not status.is_in_progress():
+                            break
+                        time.sleep(1)
+                    if not status.is_complete():
+                        logging.warning("No se pudieron crear %d carpetas en Dropbox: %s", len(chunk), status)
+                        continue
+                    result = status.get_complete()
+            except Exception as e:
+                logging.warning("Error creando %d carpetas en Dropbox: %s", len(chunk), e)
+                continue
+            for path, entry in zip(chunk, result.entries):
+                if entry.is_failure():
+                    error = entry.get_failure()
+                    if not (error.is_path() and error.get_path().is_conflict()):
+                        logging.warning("No se pudo crear la carpeta %s: %s", path, error)
+
+    def walk_sharepoint(self, source_folder, target_folder, out_queue, incremental=False):
+        """
+        Productor: recorre el árbol de SharePoint nivel por nivel y encola una tupla
+        (sp_path, dbx_path, size, remote) por archivo, mientras los workers ya
+        migran lo encolado. Las carpetas de Dropbox de cada nivel se crean en una
+        sola llamada por lotes. Al terminar encola None, o la excepción si falla.
+        """
         try:
-            self.dbx.files_create_folder_v2(target_folder)
-        except Exception:
-            pass
-        logging.info("'%s': %d archivos, %d subfolders", source_folder, len(files), len(subs))
-        with ThreadPoolExecutor(max_workers=5) as ex:
-            futures = []
-            for f in files:
-                sp = f.serverRelativeUrl
-                db = f"{target_folder}/{f.properties['Name']}"
-                futures.append(ex.submit(self.migrate_file, sp, db))
-            for _ in tqdm(futures, desc=f"Migrando {source_folder}", unit="file"):
-                pass
-        for sub in subs:
-            name = sub.properties['Name']
-            self.start_migration(sub.serverRelativeUrl, f"{target_folder}/{name}")
+            level = [(source_folder, target_folder)]
+            self.create_dropbox_folders([target_folder])
+            while level:
+                next_level = []
+                for sp_folder, dbx_folder in level:
+                    folder = (
+                        self.ctx.web
+                            .get_folder_by_server_relative_url(sp_folder)
+                            .select(["Folders/Name", "Folders/ServerRelativeUrl"])
+                            .expand(["Folders"])
+                    )
+                    self.ctx.load(folder)
+                    self.ctx.execute_query()
+                    subs = folder.folders
+                    existing = self.list_dropbox_files(dbx_folder) if incremental else {}
+                    n_files = 0
+                    for f in self.list_folder(sp_folder):
+                        n_files += 1
+                        name = f.properties['Name']
+                        size = int(f.properties.get('Length', 0))
+                        remote = existing.get(name.lower())
+                        if remote is not None and remote.size != size:
+                            remote = None
+                        out_queue.put((f.serverRelativeUrl, f"{dbx_folder}/{name}", size, remote))
+                    logging.info("'%s': %d archivos, %d subfolders", sp_folder, n_files, len(subs))
+                    for sub in subs:
+                        next_level.append((sub.serverRelativeUrl, f"{dbx_folder}/{sub.properties['Name']}"))
+                if next_level:
+                    self.create_dropbox_folders([dbx for _, dbx in next_level])
+                level = next_level
+        except Exception as e:
+            out_queue.put(e)
+        else:
+            out_queue.put(None)
+
+    def start_migration(self, source_folder, target_folder, incremental=False):
+        """
+        Migra source_folder (SharePoint) a target_folder (Dropbox) recursivamente.
+        El listado corre en un hilo aparte y alimenta a los workers por una cola,
+        así la transferencia empieza sin esperar a recorrer todo el árbol.
+        Con incremental=True, omite los archivos que ya existen en Dropbox con
+        el mismo tamaño y content_hash.
+        """
+        listing = queue.Queue(maxsize=LISTING_QUEUE_SIZE)
+        producer = threading.Thread(
+            target=self.walk_sharepoint,
+            args=(source_folder, target_folder, listing, incremental),
+            name="sharepoint-walk",
+            daemon=True,
+        )
+        producer.start()
+        uploads = queue.Queue(maxsize=UPLOAD_QUEUE_SIZE)
+        uploaders = [
+            threading.Thread(target=self.upload_worker, args=(uploads,), name=f"upload-{i}", daemon=True)
+            for i in range(UPLOAD_WORKERS)
+        ]
+        for t in uploaders:
+            t.start()
+        pending = []
+        progress_lock = threading.Lock()
+        with tqdm(total=0, unit='B', unit_scale=True, desc=f"Migrando {source_folder}") as pbar:
+            def advance(size):
+                with progress_lock:
+                    pbar.update(size)
+
+            def on_done(fut, sp, size):
+                # Corre al terminar cada archivo (en el hilo del worker): el progreso
+                # y los errores se reflejan al momento, aunque el listado siga en curso
+                if fut.exception() is not None:
+                    logging.error("Error inesperado migrando %s: %s", sp, fut.exception())
+                    advance(size)
+                elif isinstance(fut.result(), Future):
+                    # Archivo en el lote: cuenta recién cuando Dropbox confirma el commit
+                    fut.result().add_done_callback(lambda _: advance(size))
+                else:
+                    advance(size)
+
+            try:
+                while True:
+                    item = listing.get()
+                    if item is None:
+                        break
+                    if isinstance(item, Exception):
+                        raise item
+                    sp, db, size, remote = item
+                    if size <= UPLOAD_THRESHOLD:
+                        fut = self._executor.submit(self.download_small_file, sp, db, uploads, remote)
+                    else:
+                        fut = self._executor.submit(self.migrate_file, sp, db, remote)
+                    with progress_lock:
+                        pbar.total += size
+                        pbar.refresh()
+                    fut.add_done_callback(functools.partial(on_done, sp=sp, size=size))
+                    pending.append(fut)
+            finally:
+                # Se espera con la barra aún abierta para que los callbacks la actualicen
+                wait(pending)
+                for _ in uploaders:
+                    uploads.put(None)
+                for t in uploaders:
+                    t.join()
+                self.flush_upload_batch()
+
+        failed = 0
+        for fut in pending:
+            result = False if fut.exception() is not None else fut.result()
+            if isinstance(result, Future):
+                result = result.done() and result.result()
+            if not result:
+                failed += 1
+        if failed:
+            logging.error("Migración terminada con %d de %d archivos fallidos", failed, len(pending))
+        else:
+            logging.info("Migración terminada: %d archivos", len(pending))
+        return failed
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Migra una carpeta de SharePoint a Dropbox Business")
+    parser.add_argument('--incremental', action='store_true',
+                        help="omite archivos que ya existen en Dropbox con el mismo contenido")
+    args = parser.parse_args()
     try:
         migrator = SharePointToDropboxMigrator()
         sp_folder  = os.getenv('SHAREPOINT_FOLDER')
         dbx_folder = os.getenv('DROPBOX_FOLDER')
         if not all([sp_folder, dbx_folder]):
             raise ValueError("Faltan SHAREPOINT_FOLDER o DROPBOX_FOLDER en el .env")
-        migrator.start_migration(sp_folder, dbx_folder)
+        try:
+            failed = migrator.start_migration(sp_folder, dbx_folder, incremental=args.incremental)
+        finally:
+            migrator.close()
+        if failed:
+            sys.exit(1)
     except Exception as err:
         logging.error("Error en ejecución: %s", err)
         sys.exit(1)
@@ -1,86 +1,485 @@
 # test_dropbox.py
 
 import os
+import sys
+import json
+import time
+import asyncio
+import hashlib
+import argparse
+from dataclasses import dataclass
+import aiohttp
 from dotenv import load_dotenv
-from dropbox import DropboxTeam
-from dropbox.files import FileMetadata, FolderMetadata
 import logging
 
-def main():
-    load_dotenv()
+API_URL   = "https://api.dropboxapi.com/2"
+TOKEN_URL = "https://api.dropboxapi.com/oauth2/token"
+NOTIFY_URL = "https://notify.dropboxapi.com/2"
 
+# Conexiones simultáneas a la API y tiempo máximo por petición (segundos)
+POOL_SIZE    = 20
+HTTP_TIMEOUT = 60
+
+# Margen (segundos) con el que se renueva el token antes de que caduque
+TOKEN_MIN_TTL = 300
+
+# Reintentos ante límite de tasa (HTTP 429) o servicio no disponible (503)
+RATE_LIMIT_RETRIES = 3
+
+# Caché local email → team_member_id (el mapeo casi nunca cambia)
+MEMBER_CACHE_PATH = os.path.expanduser("~/.cache/sharepoint_to_dropbox/team_members.json")
+MEMBER_CACHE_TTL  = 24 * 3600  # segundos
+
+# Entradas por página de files/list_folder (máximo de la API)
+LIST_LIMIT = 2000
+
+# Cursores de list_folder guardados entre ejecuciones (listado solo de cambios)
+CURSOR_DIR = os.path.expanduser("~/.cache/sharepoint_to_dropbox/cursors")
+# Espera máxima de list_folder/longpoll en modo --watch (máximo de la API)
+LONGPOLL_TIMEOUT = 480  # segundos
+# Espera máxima entre reintentos de --watch ante errores transitorios
+WATCH_MAX_BACKOFF = 300  # segundos
+
+# Líneas del listado acumuladas por cada escritura a stdout
+PRINT_BATCH = 1000
+
+# Archivos de hasta este tamaño se suben directo; los mayores, por sesión de carga
+# (mismo criterio que UPLOAD_THRESHOLD en el migrador: size <= umbral es pequeño)
+SMALL_FILE_MAX = 150 * 1024 * 1024  # 150 MB
+
+
+@dataclass(frozen=True)
+class DbxSettings:
+    """Configuración de Dropbox leída una sola vez del .env."""
+    app_key:       str
+    app_secret:    str
+    refresh_token: str
+    member_email:  str             # p.ej. jose.roman@ucacue.edu.ec
+    folder:        str = ""        # p.ej. "/Miembros/jose.roman"
+
+    @classmethod
+    def from_env(cls):
+        load_dotenv()
+        required = ("DROPBOX_APP_KEY", "DROPBOX_APP_SECRET", "DROPBOX_REFRESH_TOKEN", "DROPBOX_MEMBER_EMAIL")
+        missing = [name for name in required if not os.getenv(name)]
+        if missing:
+            raise ValueError(f"Faltan variables de Dropbox en .env: {', '.join(missing)}")
+        return cls(*(os.getenv(name) for name in required), folder=os.getenv("DROPBOX_FOLDER", ""))
+
+
+class DropboxApiError(Exception):
+    """Error devuelto por un endpoint de la API de Dropbox."""
+    def __init__(self, route, status, body):
+        super().__init__(f"{route} → HTTP {status}: {body}")
+        self.route  = route
+        self.status = status
+        self.body   = body
+
+    @property
+    def tag(self):
+        """Etiqueta del error (p.ej. "reset"), o None si el cuerpo no la trae."""
+        try:
+            error = json.loads(self.body).get("error")
+        except (ValueError, AttributeError):
+            return None
+        return error.get(".tag") if isinstance(error, dict) else None
+
+
+class AsyncDropboxClient:
+    """
+    Cliente mínimo y asíncrono de la API de Dropbox sobre aiohttp.
+    Cada endpoint usado por el script es un método (como en aiodbx) y todas
+    las llamadas comparten un mismo pool de conexiones.
+    """
+    def __init__(self, app_key, app_secret, refresh_token, session=None, select_user=None,
+                 token=None, token_lock=None):
+        self.app_key       = app_key
+        self.app_secret    = app_secret
+        self.refresh_token = refresh_token
+        self._session      = session
+        self._owns_session = session is None
+        self._select_user  = select_user
+        # Compartidos con los clientes creados por as_user(): un solo token y
+        # un solo refresco a la vez, aunque haya muchas llamadas concurrentes
+        self._token        = token if token is not None else {}
+        self._token_lock   = token_lock if token_lock is not None else asyncio.Lock()
+
+    async def __aenter__(self):
+        if self._session is None:
+            # Un solo pool para el equipo y los miembros impersonados: conexiones
+            # TLS mantenidas vivas y DNS cacheado entre llamadas
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=POOL_SIZE, limit_per_host=POOL_SIZE,
+                    keepalive_timeout=60, ttl_dns_cache=300,
+                ),
+                timeout=aiohttp.ClientTimeout(total=HTTP_TIMEOUT),
+            )
+        # Se obtiene el token antes de repartir llamadas concurrentes
+        try:
+            await self._access_token()
+        except BaseException:
+            # Si falla, __aexit__ no se ejecuta: se cierra la sesión aquí
+            await self.__aexit__(None, None, None)
+            raise
+        return self
+
+    async def __aexit__(self, *exc):
+        if self._owns_session and self._session is not None:
+            await self._session.close()
+
+    def as_user(self, team_member_id):
+        """Cliente que actúa como el miembro indicado (cabecera Dropbox-API-Select-User)."""
+        return AsyncDropboxClient(
+            self.app_key, self.app_secret, self.refresh_token,
+            session=self._session, select_user=team_member_id,
+            token=self._token, token_lock=self._token_lock
+        )
+
+    def _token_valid(self):
+        return "access_token" in self._token and time.monotonic() < self._token["expires_at"]
+
+    async def _access_token(self):
+        if not self._token_valid():
+            async with self._token_lock:
+                # Otra tarea pudo refrescarlo mientras se esperaba el lock
+                if not self._token_valid():
+                    async with self._session.post(
+                        TOKEN_URL,
+                        data={"grant_type": "refresh_token", "refresh_token": self.refresh_token},
+                        auth=aiohttp.BasicAuth(self.app_key, self.app_secret),
+                    ) as resp:
+                        if resp.status != 200:
+                            raise DropboxApiError("oauth2/token", resp.status, await resp.text())
+                        data = await resp.json()
+                    self._token["access_token"] = data["access_token"]
+                    self._token["expires_at"]   = time.monotonic() + data.get("expires_in", 14400) - TOKEN_MIN_TTL
+        return self._token["access_token"]
+
+    async def _rpc(self, route, arg=None):
+        kwargs = {"json": arg} if arg is not None else {}
+        attempt = 0
+        refreshed = False
+        while True:
+            headers = {"Authorization": f"Bearer {await self._access_token()}"}
+            if self._select_user:
+                headers["Dropbox-API-Select-User"] = self._select_user
+            async with self._session.post(f"{API_URL}/{route}", headers=headers, **kwargs) as resp:
+                if resp.status == 200:
+                    return await resp.json()
+                status, body = resp.status, await resp.text()
+                retry_after = resp.headers.get("Retry-After")
+
+            if status == 401 and not refreshed:
+                # Token caducado o revocado: se pide uno nuevo una sola vez
+                self._token.pop("access_token", None)
+                refreshed = True
+                continue
+            if status not in (429, 503) or attempt >= RATE_LIMIT_RETRIES:
+                raise DropboxApiError(route, status, body)
+
+            # Dropbox indica cuánto esperar; sin la cabecera, backoff exponencial
+            delay = float(retry_after) if retry_after else min(2 ** attempt, 30)
+            attempt += 1
+            logging.warning("%s limitado (HTTP %s); reintento %d en %.1fs", route, status, attempt, delay)
+            await asyncio.sleep(delay)
+
+    async def team_members_get_info(self, emails):
+        arg = {"members": [{".tag": "email", "email": email} for email in emails]}
+        return await self._rpc("team/members/get_info_v2", arg)
+
+    async def team_members_list_v2(self, limit=1000, include_removed=False):
+        return await self._rpc("team/members/list_v2", {"limit": limit, "include_removed": include_removed})
+
+    async def team_members_list_continue_v2(self, cursor):
+        return await self._rpc("team/members/list/continue_v2", {"cursor": cursor})
+
+    async def users_get_current_account(self):
+        return await self._rpc("users/get_current_account")
+
+    async def files_list_folder(self, path, recursive=False, limit=None, include_non_downloadable_files=True):
+        arg = {"path": path, "recursive": recursive,
+               "include_non_downloadable_files": include_non_downloadable_files}
+        if limit is not None:
+            arg["limit"] = limit
+        return await self._rpc("files/list_folder", arg)
+
+    async def files_list_folder_continue(self, cursor):
+        return await self._rpc("files/list_folder/continue", {"cursor": cursor})
+
+    async def files_list_folder_longpoll(self, cursor, timeout=30):
+        """Espera cambios sobre un cursor; va a notify.dropboxapi.com y no lleva token."""
+        # Dropbox añade hasta 90 s de margen aleatorio a la espera pedida
+        async with self._session.post(
+            f"{NOTIFY_URL}/files/list_folder/longpoll",
+            json={"cursor": cursor, "timeout": timeout},
+            timeout=aiohttp.ClientTimeout(total=timeout + 90),
+        ) as resp:
+            if resp.status != 200:
+                raise DropboxApiError("files/list_folder/longpoll", resp.status, await resp.text())
+            return await resp.json()
+
+
+def _load_member_id_cache():
+    """Lee la caché de miembros; retorna un dict vacío si no existe o está corrupta."""
+    try:
+        with open(MEMBER_CACHE_PATH, encoding="utf-8") as fh:
+            return json.load(fh)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_member_id_cache(cache):
+    """Escribe la caché de miembros de forma atómica."""
+    os.makedirs(os.path.dirname(MEMBER_CACHE_PATH), exist_ok=True)
+    tmp_path = f"{MEMBER_CACHE_PATH}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as fh:
+        json.dump(cache, fh)
+    os.replace(tmp_path, MEMBER_CACHE_PATH)
+
+
+async def find_team_member_id(team_client, email):
+    """
+    Resuelve el team_member_id de un email con members/get_info (un solo registro).
+    Si el endpoint falla, recurre a recorrer el listado del equipo.
+    """
+    try:
+        info = await team_client.team_members_get_info([email])
+        member_info = info["members_info"][0]
+        if member_info[".tag"] != "member_info":
+            return None
+        return member_info["profile"]["team_member_id"]
+    except DropboxApiError as e:
+        logging.warning("members/get_info falló (%s); se recorre el listado del equipo", e)
+
+    # Páginas máximas y sin miembros eliminados; se deja de paginar al encontrarlo
+    target = email.casefold()
+    result = await team_client.team_members_list_v2(limit=1000, include_removed=False)
+    while True:
+        for m in result["members"]:
+            profile = m["profile"]
+            if profile["email"].casefold() == target:
+                return profile["team_member_id"]
+        if not result["has_more"]:
+            return None
+        result = await team_client.team_members_list_continue_v2(result["cursor"])
+
+
+# Tipo de cada entrada según su etiqueta ".tag"; los archivos se separan
+# en pequeños (subida directa) y grandes (sesión por chunks)
+_KIND = {"folder": "folder", "file": "small", "deleted": "deleted"}
+
+def _kind(entry):
+    kind = _KIND.get(entry[".tag"], "unknown")
+    if kind == "small" and entry["size"] > SMALL_FILE_MAX:
+        return "large"
+    return kind
+
+
+async def prefetch_next_page(member, res):
+    """
+    Lanza en segundo plano la petición de la página siguiente (si la hay).
+    Como cada página depende del cursor de la anterior, nunca hay más de una en vuelo.
+    """
+    if not res["has_more"]:
+        return None
+    task = asyncio.create_task(member.files_list_folder_continue(res["cursor"]))
+    # Cede el bucle una vez para que la petición salga antes de imprimir
+    await asyncio.sleep(0)
+    return task
+
+
+def _cursor_path(team_member_id, path, recursive):
+    """Archivo donde se guarda el cursor de un listado (miembro, carpeta y modo)."""
+    key = hashlib.sha1(f"{team_member_id}:{recursive}:{path.casefold()}".encode("utf-8")).hexdigest()
+    return os.path.join(CURSOR_DIR, f"{key}.cursor")
+
+
+def _load_cursor(cursor_file):
+    try:
+        with open(cursor_file, encoding="utf-8") as fh:
+            return fh.read().strip() or None
+    except OSError:
+        return None
+
+
+def _save_cursor(cursor_file, cursor):
+    """Escribe el cursor de forma atómica."""
+    os.makedirs(os.path.dirname(cursor_file), exist_ok=True)
+    tmp_path = f"{cursor_file}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as fh:
+        fh.write(cursor)
+    os.replace(tmp_path, cursor_file)
+
+
+async def iter_folder(member, path, recursive=False, cursor_file=None, first_page=None):
+    """
+    Genera pares (entrada, tipo) de una carpeta como un único flujo, paginando
+    con el cursor. El tipo es "folder", "small" o "large" (ver SMALL_FILE_MAX),
+    para repartir los archivos entre la cola de subida directa y la de sesiones.
+    Solo se retienen la página actual y la siguiente (que se pide antes de
+    entregar la actual, para solapar la red con el procesamiento).
+
+    Para solapar la primera página con otras llamadas, el que invoca puede
+    lanzarla antes como tarea de _first_page y pasarla en first_page; cancelarla
+    si no llega a iterar queda a su cargo.
+
+    Con cursor_file, si hay un cursor guardado solo se generan los cambios desde
+    la ejecución anterior (incluidas entradas "deleted"), y al terminar se guarda
+    el cursor nuevo.
+    """
+    if first_page is None:
+        first_page = _first_page(member, path, recursive, cursor_file)
+    res = await first_page
+    while True:
+        next_page = await prefetch_next_page(member, res)
+        for entry in res["entries"]:
+            yield entry, _kind(entry)
+        if next_page is None:
+            break
+        res = await next_page
+    if cursor_file:
+        _save_cursor(cursor_file, res["cursor"])
+
+
+async def _first_page(member, path, recursive, cursor_file):
+    """Primera página del listado: desde el cursor guardado si lo hay, o completa."""
+    cursor = _load_cursor(cursor_file) if cursor_file else None
+    if cursor:
+        try:
+            return await member.files_list_folder_continue(cursor)
+        except DropboxApiError as e:
+            # Dropbox invalidó el cursor (reset): hay que volver a listar todo
+            if e.status != 409 or e.tag != "reset":
+                raise
+            logging.info("Cursor de %s invalidado por Dropbox; se lista completo", path)
+    return await member.files_list_folder(path, recursive=recursive, limit=LIST_LIMIT,
+                                          include_non_downloadable_files=False)
+
+
+async def print_entries(entries):
+    """Imprime un listado en bloques (un solo write por bloque) y su resumen por tipo."""
+    lines = []
+    totals = {}
+    async for entry, kind in entries:
+        totals[kind] = totals.get(kind, 0) + 1
+        lines.append(f" - {entry['path_display']} ({kind})")
+        if len(lines) >= PRINT_BATCH:
+            sys.stdout.write("\n".join(lines) + "\n")
+            lines.clear()
+    if lines:
+        sys.stdout.write("\n".join(lines) + "\n")
+    summary = (f"\n📊 Carpetas: {totals.get('folder', 0)} | "
+               f"archivos pequeños: {totals.get('small', 0)} | grandes: {totals.get('large', 0)}")
+    if totals.get("deleted"):
+        summary += f" | eliminados: {totals['deleted']}"
+    print(summary)
+
+
+async def main(watch=False, full=False):
     # Lee tus credenciales y datos del .env
-    APP_KEY          = os.getenv("DROPBOX_APP_KEY")
-    APP_SECRET       = os.getenv("DROPBOX_APP_SECRET")
-    REFRESH_TOKEN    = os.getenv("DROPBOX_REFRESH_TOKEN")
-    MEMBER_EMAIL     = os.getenv("DROPBOX_MEMBER_EMAIL")     # p.ej. jose.roman@ucacue.edu.ec
-    DROPBOX_FOLDER   = os.getenv("DROPBOX_FOLDER", "")      # p.ej. "/Miembros/jose.roman"
+    settings = DbxSettings.from_env()
+    MEMBER_EMAIL   = settings.member_email
+    DROPBOX_FOLDER = settings.folder
 
     # 1) Conecta como equipo
-    team_client = DropboxTeam(
-        app_key=APP_KEY,
-        app_secret=APP_SECRET,
-        oauth2_refresh_token=REFRESH_TOKEN
-    )
-
-    # 2) Busca el team_member_id por email
-    print(f"🔍 Buscando miembro {MEMBER_EMAIL} en el equipo…")
-    result = team_client.team_members_list()
-    team_member_id = None
-    for m in result.members:
-        if m.profile.email.lower() == MEMBER_EMAIL.lower():
-            team_member_id = m.profile.team_member_id
-            break
+    async with AsyncDropboxClient(settings.app_key, settings.app_secret, settings.refresh_token) as team_client:
+
+        # 2) Busca el team_member_id por email, primero en la caché local
+        print(f"🔍 Buscando miembro {MEMBER_EMAIL} en el equipo…")
+        cache = _load_member_id_cache()
+        email_key = MEMBER_EMAIL.casefold()
+        cached = cache.get(email_key)
+        if cached and time.time() - cached["cached_at"] < MEMBER_CACHE_TTL:
+            team_member_id = cached["team_member_id"]
+        else:
+            # Fallo de caché: se pide solo ese miembro y se guarda
+            team_member_id = await find_team_member_id(team_client, MEMBER_EMAIL)
+            if team_member_id:
+                cache[email_key] = {"team_member_id": team_member_id, "cached_at": time.time()}
+                _save_member_id_cache(cache)
+
+        if not team_member_id:
+            print(f"❌ No encontré a {MEMBER_EMAIL} en tu equipo.")
+            return
+
+        print(f"✅ Encontrado: {MEMBER_EMAIL} → team_member_id={team_member_id}\n")
+
+        # 3) Impersona al miembro con su ID; la cuenta y la primera página del
+        #    listado (paso 4) se piden a la vez
+        member = team_client.as_user(team_member_id)
+        cursor_file = _cursor_path(team_member_id, DROPBOX_FOLDER, recursive=True)
+        if full and os.path.exists(cursor_file):
+            os.remove(cursor_file)
+        resumed = os.path.exists(cursor_file)
+        first_page = asyncio.create_task(_first_page(member, DROPBOX_FOLDER, True, cursor_file))
+        try:
+            acct = await member.users_get_current_account()
+        except BaseException:
+            first_page.cancel()
+            raise
+        entries = iter_folder(member, DROPBOX_FOLDER, recursive=True, cursor_file=cursor_file,
+                              first_page=first_page)
+        print(f"👤 Actuando como: {acct['email']} ({acct['name']['display_name']})\n")
 
-    if not team_member_id:
-        print(f"❌ No encontré a {MEMBER_EMAIL} en tu equipo.")
-        return
-
-    print(f"✅ Encontrado: {MEMBER_EMAIL} → team_member_id={team_member_id}\n")
-
-    # 3) Impersona al miembro con su ID
-    member = team_client.as_user(team_member_id)
-    acct = member.users_get_current_account()
-    print(f"👤 Actuando como: {acct.email} ({acct.name.display_name})\n")
-
-    # 4) Lista la carpeta destino en su espacio
-    print(f"📂 Contenido de '{DROPBOX_FOLDER}':")
-    res = member.files_list_folder(DROPBOX_FOLDER)
-    for entry in res.entries:
-        if isinstance(entry, FolderMetadata):
-            kind = "folder"
-        elif isinstance(entry, FileMetadata):
-            kind = "file"
+        # 4) Lista todo el árbol de la carpeta destino en su espacio; el servidor
+        #    recorre las subcarpetas y se pagina solo por número de entradas.
+        #    Con un cursor de una ejecución anterior solo se listan los cambios.
+        if resumed:
+            print(f"📂 Cambios en '{DROPBOX_FOLDER}' desde la última ejecución:")
         else:
-            kind = "unknown"
-        print(f" - {entry.name} ({kind})")
-
-    while res.has_more:
-        res = member.files_list_folder_continue(res.cursor)
-        for entry in res.entries:
-            if isinstance(entry, FolderMetadata):
-                kind = "folder"
-            elif isinstance(entry, FileMetadata):
-                kind = "file"
-            else:
-                kind = "unknown"
-            print(f" - {entry.name} ({kind})")
-    
-    # Listado recursivo de TODOS los elementos desde la raíz
-    # print("🔍 Listado recursivo de TODO el árbol:")
-    # res = member.files_list_folder(path="", recursive=True)
-
-    # for entry in res.entries:
-    #     print(f" - {entry.path_display}")
-
-    # # Paginación
-    # while res.has_more:
-    #     res = member.files_list_folder_continue(res.cursor)
-    #     for entry in res.entries:
-    #         print(f" - {entry.path_display}")
+            print(f"📂 Contenido de '{DROPBOX_FOLDER}' (recursivo):")
+        await print_entries(entries)
 
+        # 5) Modo --watch: espera cambios con longpoll en vez de volver a listar.
+        #    Un cursor invalidado (reset) obliga a listar todo de nuevo; los
+        #    errores transitorios se reintentan con backoff sin cortar el bucle.
+        failures = 0
+        relist = False
+        while watch:
+            try:
+                if relist:
+                    print(f"\n📂 Contenido de '{DROPBOX_FOLDER}' (recursivo):")
+                    await print_entries(iter_folder(member, DROPBOX_FOLDER, recursive=True, cursor_file=cursor_file))
+                    relist = False
+                result = await member.files_list_folder_longpoll(_load_cursor(cursor_file), LONGPOLL_TIMEOUT)
+                if result["changes"]:
+                    print(f"\n🔔 Cambios en '{DROPBOX_FOLDER}':")
+                    await print_entries(iter_folder(member, DROPBOX_FOLDER, recursive=True, cursor_file=cursor_file))
+                failures = 0
+                if result.get("backoff"):
+                    await asyncio.sleep(result["backoff"])
+                continue
+            except DropboxApiError as e:
+                if e.status == 409 and e.tag == "reset":
+                    logging.warning("Cursor de %s invalidado por Dropbox; se lista completo", DROPBOX_FOLDER)
+                    if os.path.exists(cursor_file):
+                        os.remove(cursor_file)
+                    relist = True
+                    continue
+                if e.status < 500 and e.status != 429:
+                    raise
+                error = e
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error = e
+            failures += 1
+            delay = min(2 ** failures, WATCH_MAX_BACKOFF)
+            logging.warning("Error esperando cambios (%s); reintento en %ss", error, delay)
+            await asyncio.sleep(delay)
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Lista la carpeta de Dropbox de un miembro del equipo")
+    parser.add_argument("--watch", action="store_true",
+                        help="tras el listado, espera cambios (longpoll) y los muestra")
+    parser.add_argument("--full", action="store_true",
+                        help="descarta el cursor guardado y lista todo desde cero")
+    args = parser.parse_args()
     logging.basicConfig(level=logging.INFO)
-    main()
+    # uvloop (opcional) reduce el costo por tarea del bucle de eventos
+    try:
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    except ImportError:
+        pass
+    asyncio.run(main(watch=args.watch, full=args.full))
@@ -1,22 +1,99 @@
 # Import libraries
 from office365.sharepoint.client_context import ClientContext
+from office365.runtime.auth.authentication_context import AuthenticationContext
 from office365.runtime.auth.client_credential import ClientCredential
 
 import os
+import asyncio
+import functools
+import threading
+from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
-load_dotenv()
-
-# 2) Lee variables de entorno
-SP_CLIENT_ID     = os.getenv("SHAREPOINT_CLIENT_ID")
-SP_CLIENT_SECRET = os.getenv("SHAREPOINT_CLIENT_SECRET")
-SP_URL      = os.getenv("SHAREPOINT_SITE_URL")
-relative_folder_url   = os.getenv("SHAREPOINT_FOLDER")
-# App-based authentication with access credentials
-context = ClientContext(SP_URL).with_credentials(ClientCredential(SP_CLIENT_ID, SP_CLIENT_SECRET))
-folder = context.web.get_folder_by_server_relative_url(relative_folder_url).expand(["Files"])
-context.load(folder)
-context.execute_query()
-
-# Processes each Sharepoint file in folder
-for file in folder.files:
-    print(f'Processing file: {file.properties["Name"]}')
+
+# Folders listed concurrently (office365 is synchronous, so each listing runs in a thread)
+LIST_WORKERS = 16
+PAGE_SIZE    = 5000
+
+_local = threading.local()
+
+@dataclass(frozen=True)
+class SpSettings:
+    """SharePoint settings, read once from .env."""
+    client_id:     str
+    client_secret: str
+    site_url:      str
+    folder:        str
+
+    @classmethod
+    def from_env(cls):
+        # 2) Lee variables de entorno
+        load_dotenv()
+        required = ("SHAREPOINT_CLIENT_ID", "SHAREPOINT_CLIENT_SECRET", "SHAREPOINT_SITE_URL", "SHAREPOINT_FOLDER")
+        missing = [name for name in required if not os.getenv(name)]
+        if missing:
+            raise ValueError(f"Faltan variables de SharePoint en .env: {', '.join(missing)}")
+        return cls(*(os.getenv(name) for name in required))
+
+@functools.lru_cache(maxsize=1)
+def get_auth(settings):
+    """App-based authentication shared by every context, so the access token is requested once."""
+    return AuthenticationContext(settings.site_url).with_credentials(
+        ClientCredential(settings.client_id, settings.client_secret)
+    )
+
+def get_ctx(settings):
+    """One ClientContext per thread: pending queries live in the context, so it can't be shared."""
+    if not hasattr(_local, "context"):
+        auth = get_auth(settings)
+        _local.context = ClientContext(auth.url, auth_context=auth)
+    return _local.context
+
+def list_folder(settings, url):
+    """Returns the file names and subfolder URLs of a folder, paging server-side."""
+    ctx = get_ctx(settings)
+    folder = ctx.web.get_folder_by_server_relative_url(url)
+    names = []
+
+    def page_loaded(files):
+        # The collection is cumulative; only the newly loaded page is read
+        names.extend(f.properties["Name"] for f in files[len(names):])
+
+    files = folder.files.select(["Name"]).get_all(PAGE_SIZE, page_loaded)
+    subfolders = folder.folders.select(["ServerRelativeUrl"]).get_all(PAGE_SIZE)
+    ctx.execute_query()
+    # A full page with no next link means the server isn't paging this collection,
+    # so it is requested again without $top instead of being truncated
+    if len(files) >= PAGE_SIZE and not files.has_next:
+        files = ctx.web.get_folder_by_server_relative_url(url).files.select(["Name"]).get().execute_query()
+        names = [f.properties["Name"] for f in files]
+    if len(subfolders) >= PAGE_SIZE and not subfolders.has_next:
+        subfolders = ctx.web.get_folder_by_server_relative_url(url).folders.select(["ServerRelativeUrl"]).get().execute_query()
+    return names, [f.properties["ServerRelativeUrl"] for f in subfolders]
+
+async def walk(settings, root_url):
+    """Lists the tree level by level; every folder of a level is requested at once."""
+    loop = asyncio.get_running_loop()
+    with ThreadPoolExecutor(max_workers=LIST_WORKERS) as pool:
+        pending = [root_url]
+        while pending:
+            results = await asyncio.gather(*(loop.run_in_executor(pool, list_folder, settings, url) for url in pending))
+            pending = []
+            for names, subfolders in results:
+                # Processes each Sharepoint file in folder
+                for name in names:
+                    print(f'Processing file: {name}')
+                pending.extend(subfolders)
+
+def main():
+    settings = SpSettings.from_env()
+    asyncio.run(walk(settings, settings.folder))
+
+if __name__ == "__main__":
+    # Optional uvloop: lower per-task overhead in the event loop
+    try:
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    except ImportError:
+        pass
+    main()